@@ -2,12 +2,73 @@
 
 from __future__ import annotations
 
-import glob
+import json
 import os
-from typing import List, Tuple
+import re
+import tempfile
+from itertools import chain
+from typing import List, Optional, Tuple
 
 import numpy as np
 
+PATIENT_ID_CACHE = ".patient_ids.json"
+# Bumped whenever filename parsing changes, so caches written by older code are rebuilt.
+PATIENT_ID_CACHE_VERSION = 2
+
+# ``<pid>_<mod>_<type>_<idx>.nii[.gz]``; label patches are skipped.
+PATCH_FILENAME_RE = re.compile(r"^(?!.*label)(.+)_[^_]+_[^_]+_\d+\.nii(?:\.gz)?$")
+
+
+def _dir_mtime(path: str) -> Optional[float]:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _scan_patient_ids(patch_dirs: List[str]) -> List[str]:
+    """Collect patient IDs from ``<pid>_<mod>_<type>_<idx>.nii*`` patch filenames."""
+    patient_ids = set()
+    for patch_dir in patch_dirs:
+        if not os.path.isdir(patch_dir):
+            continue
+        with os.scandir(patch_dir) as entries:
+            for entry in entries:
+                # Match ``glob("*.nii*")``: no hidden files (e.g. macOS ``._*``) and no directories.
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                match = PATCH_FILENAME_RE.match(entry.name)
+                if match:
+                    patient_ids.add(match.group(1))
+    return sorted(patient_ids)
+
+
+def _cached_patient_ids(data_dir: str, patch_dirs: List[str]) -> List[str]:
+    """Return patient IDs, reusing ``PATIENT_ID_CACHE`` while the patch directories are unchanged."""
+    cache_path = os.path.join(data_dir, PATIENT_ID_CACHE)
+    key = [_dir_mtime(patch_dir) for patch_dir in patch_dirs]
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache.get("version") == PATIENT_ID_CACHE_VERSION and cache.get("key") == key:
+            return list(cache["patient_ids"])
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    patient_ids = _scan_patient_ids(patch_dirs)
+    # Write to a temporary file and rename it into place, so ranks that build the
+    # cache concurrently never read a partially written file.
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile("w", dir=data_dir, prefix=PATIENT_ID_CACHE, delete=False) as f:
+            tmp_path = f.name
+            json.dump({"version": PATIENT_ID_CACHE_VERSION, "key": key, "patient_ids": patient_ids}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return patient_ids
+
 
 def train_validate_dicts(data_dir: str, args) -> Tuple[List[str], List[str]]:
     """Split patient IDs into train and validation folds.
@@ -19,31 +80,15 @@ def train_validate_dicts(data_dir: str, args) -> Tuple[List[str], List[str]]:
     args: Namespace
         Requires ``split`` and ``max_splits`` attributes to control the number of
         cross-validation folds and which fold is used for validation.
+
+    The patient IDs parsed from the patch filenames are cached in
+    ``data_dir/.patient_ids.json`` and reused until either patch directory is
+    modified.
     """
     lesion_patch_dir = os.path.join(data_dir, "lesion_patches")
     background_patch_dir = os.path.join(data_dir, "background_patches")
 
-    lesion_files = glob.glob(os.path.join(lesion_patch_dir, "*.nii*"))
-    background_files = glob.glob(os.path.join(background_patch_dir, "*.nii*"))
-
-    all_files = lesion_files + background_files
-
-    patient_ids = set()
-    for file_path in all_files:
-        filename = os.path.basename(file_path)
-        if "label" in filename:
-            continue
-
-        filename_no_ext = filename.replace(".nii.gz", "").replace(".nii", "")
-        parts = filename_no_ext.split("_")
-
-        if len(parts) < 4:
-            continue
-
-        patient_id = "_".join(parts[:-3])
-        patient_ids.add(patient_id)
-
-    patient_ids = sorted(list(patient_ids))
+    patient_ids = _cached_patient_ids(data_dir, [lesion_patch_dir, background_patch_dir])
     print(f"All patient IDs: {patient_ids}")
 
     np.random.seed(42)
@@ -51,16 +96,13 @@ def train_validate_dicts(data_dir: str, args) -> Tuple[List[str], List[str]]:
 
     num_patients = len(patient_ids)
     max_splits = getattr(args, "max_splits", 7)
-    num_val_patients = max(1, num_patients // max_splits)
+    num_folds = max(1, min(max_splits, num_patients))
 
-    folds = [patient_ids[i : i + num_val_patients] for i in range(0, num_patients, num_val_patients)]
-    if len(folds) > max_splits:
-        folds[-2].extend(folds[-1])
-        folds.pop()
+    folds = [fold.tolist() for fold in np.array_split(np.asarray(patient_ids), num_folds)]
 
     val_fold_index = (args.split - 1) % len(folds)
     val_patient_ids = folds[val_fold_index]
-    train_patient_ids = [p for i, fold in enumerate(folds) if i != val_fold_index for p in fold]
+    train_patient_ids = list(chain.from_iterable(fold for i, fold in enumerate(folds) if i != val_fold_index))
 
     print(f"Training patient IDs: {train_patient_ids}")
     print(f"Validation patient IDs: {val_patient_ids}")
@@ -18,77 +18,203 @@ subdirectories of the output folder using the naming convention expected by the
 from __future__ import annotations
 
 import argparse
+import functools
+import os
+import queue
+import threading
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 import nibabel as nib
 import numpy as np
 from scipy import ndimage as ndi
 
-
-def normalize_volume(img: np.ndarray) -> np.ndarray:
-    """Clip to the 1st and 99th percentiles and scale to [0, 1]."""
-    p1, p99 = np.percentile(img, (1, 99))
+# Face connectivity, the ``ndi.label`` default, built once rather than per subject.
+LESION_CONNECTIVITY = ndi.generate_binary_structure(3, 1)
+
+
+def histogram_percentiles(img: np.ndarray, q: tuple[float, ...], bins: int = 4096) -> tuple[float, ...]:
+    """Approximate percentiles ``q`` of ``img`` from a ``bins``-wide histogram.
+
+    Avoids the full partition done by ``np.percentile``. Each percentile is
+    interpolated linearly inside the bin where the cumulative count crosses its
+    rank. If two percentiles land in the same bin (e.g. a volume that is almost
+    all background), the histogram cannot separate them and ``np.percentile``
+    is used instead, so a real intensity range is never collapsed.
+    """
+    mn, mx = float(img.min()), float(img.max())
+    if mx <= mn:
+        return tuple(mn for _ in q)
+    scale = (bins - 1) / (mx - mn)
+    idx = ((img - mn) * scale).astype(np.uint16)
+    hist = np.bincount(idx.ravel(), minlength=bins)
+    cdf = np.cumsum(hist)
+    ranks = np.asarray(q, dtype=np.float64) / 100.0 * img.size
+    found = np.minimum(np.searchsorted(cdf, ranks, side="left"), bins - 1)
+    if len(np.unique(found)) < len(found):
+        return tuple(float(p) for p in np.percentile(img, q))
+    below = cdf[found] - hist[found]
+    frac = np.clip((ranks - below) / np.maximum(hist[found], 1), 0.0, 1.0)
+    return tuple(float(min(mn + (b + f) / scale, mx)) for b, f in zip(found, frac))
+
+
+def rescale_intensity(img: np.ndarray, p1: float, p99: float, out: np.ndarray | None = None) -> np.ndarray:
+    """Clip ``img`` to ``[p1, p99]`` and scale to [0, 1].
+
+    The result is written into a single ``float32`` buffer (``out`` if given)
+    that is shifted, scaled and clipped in place.
+    """
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
     if p99 <= p1:
-        return np.zeros_like(img, dtype=np.float32)
-    img = np.clip(img, p1, p99)
-    return (img - p1) / (p99 - p1)
+        out[...] = 0.0
+        return out
+    np.subtract(img, np.float32(p1), out=out, dtype=np.float32)
+    np.multiply(out, np.float32(1.0 / (p99 - p1)), out=out)
+    np.clip(out, 0.0, 1.0, out=out)
+    return out
 
 
-def ensure_size(start: int, end: int, min_size: int, max_dim: int) -> tuple[int, int]:
-    """Expand ``start``/``end`` so the interval is at least ``min_size`` long."""
-    size = end - start
-    if size >= min_size:
+def normalize_volume(img: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """Clip to the 1st and 99th percentiles and scale to [0, 1]."""
+    p1, p99 = histogram_percentiles(img, (1, 99))
+    return rescale_intensity(img, p1, p99, out=out)
+
+
+class LazyNormalizedStack:
+    """Normalized ``(M, Z, Y, X)`` view of NIfTI volumes that only reads the voxels it is sliced with.
+
+    Sliced like the stacked modality array, ``vol[:, z0:z1, y0:y1, x0:x1]``.
+    Percentiles are estimated on a strided subsample of each volume. For
+    uncompressed ``.nii`` files nibabel memory-maps the data, so extracting a
+    patch touches only the patch itself.
+    """
+
+    def __init__(self, dataobjs: list, subsample: int = 4) -> None:
+        self.dataobjs = list(dataobjs)
+        self.percentiles = [
+            histogram_percentiles(np.asarray(d[::subsample, ::subsample, ::subsample], dtype=np.float32), (1, 99))
+            for d in self.dataobjs
+        ]
+
+    def __getitem__(self, key) -> np.ndarray:
+        indices, spatial = range(len(self.dataobjs))[key[0]], key[1:]
+        patches = [np.asarray(self.dataobjs[i][spatial], dtype=np.float32) for i in indices]
+        out = np.empty((len(patches),) + patches[0].shape, dtype=np.float32)
+        for i, (patch, m) in enumerate(zip(patches, indices)):
+            rescale_intensity(patch, *self.percentiles[m], out=out[i])
+        return out
+
+
+def ensure_size(start: np.ndarray, end: np.ndarray, min_size, max_dim) -> tuple[np.ndarray, np.ndarray]:
+    """Expand ``start``/``end`` so every interval is at least ``min_size`` long.
+
+    Works element-wise, so a whole ``(N, 3)`` array of boxes is resized at once
+    with ``min_size``/``max_dim`` broadcast per axis.
+    """
+    start, end = np.asarray(start), np.asarray(end)
+    extra = np.maximum(np.asarray(min_size) - (end - start), 0)
+    if not extra.any():
         return start, end
-    extra = min_size - size
-    start = max(0, start - extra // 2)
-    end = min(max_dim, end + extra - extra // 2)
-    if end - start < min_size:
-        if start == 0:
-            end = min(max_dim, start + min_size)
-        else:
-            start = max(0, end - min_size)
+    start = np.maximum(start - extra // 2, 0)
+    end = np.minimum(end + extra - extra // 2, max_dim)
+    short = end - start < min_size
+    at_origin = short & (start == 0)
+    end = np.where(at_origin, np.minimum(start + min_size, max_dim), end)
+    start = np.where(short & ~at_origin, np.maximum(end - min_size, 0), start)
     return start, end
 
 
-def generate_indices(dim: int, patch: int, stride: int) -> list[int]:
-    """Return start indices covering ``dim`` using ``patch`` size and ``stride``."""
+@functools.lru_cache(maxsize=256)
+def generate_indices(dim: int, patch: int, stride: int) -> tuple[int, ...]:
+    """Return start indices covering ``dim`` using ``patch`` size and ``stride``.
+
+    Cached, since subjects in a dataset share only a handful of shapes.
+    """
     if dim <= patch:
-        return [0]
+        return (0,)
     starts = list(range(0, dim - patch + 1, stride))
     if starts[-1] != dim - patch:
         starts.append(dim - patch)
-    return starts
+    return tuple(starts)
+
+
+def lesion_free_starts(
+    mask: np.ndarray,
+    starts: tuple[tuple[int, ...], tuple[int, ...], tuple[int, ...]],
+    patch_size: tuple[int, int, int],
+) -> np.ndarray:
+    """Return the ``(N, 3)`` patch start coordinates whose window has no lesion.
+
+    Candidates are the Cartesian product of ``starts``. A maximum filter
+    anchored at the window start marks every position whose ``patch_size``
+    window contains a lesion. The filter is separable, so it is applied one
+    axis at a time and the result is immediately subsampled to that axis'
+    start indices; later axes then only run over the coarse grid.
+    """
+    occupied = mask.view(np.uint8) if mask.dtype == bool else (mask > 0).astype(np.uint8)
+    for axis, (axis_starts, p) in enumerate(zip(starts, patch_size)):
+        occupied = ndi.maximum_filter1d(occupied, size=p, axis=axis, mode="constant", cval=0, origin=-(p // 2))
+        occupied = np.take(occupied, axis_starts, axis=axis)
+    axes = [np.asarray(s) for s in starts]
+    return np.stack([ax[idx] for ax, idx in zip(axes, np.nonzero(occupied == 0))], axis=1)
+
+
+INT16_SCALE = 32767
+
+
+def to_nifti(data: np.ndarray, affine: np.ndarray, dtype: str) -> nib.Nifti1Image:
+    """Wrap a normalized patch in a NIfTI image stored as ``dtype``.
+
+    ``int16`` patches are quantized to ``[0, INT16_SCALE]`` and carry the
+    inverse scale in ``scl_slope`` so nibabel returns [0, 1] values on read.
+    """
+    if dtype == "int16":
+        quantized = np.rint(np.clip(data, 0.0, 1.0) * INT16_SCALE).astype(np.int16)
+        img = nib.Nifti1Image(quantized, affine)
+        img.header.set_slope_inter(1.0 / INT16_SCALE, 0.0)
+        return img
+    return nib.Nifti1Image(data.astype(np.float32, copy=False), affine)
 
 
 def save_patch(
     pid: str,
     patch_type: str,
     patch_idx: int,
-    modalities: dict[str, np.ndarray],
+    mod_names: list[str],
+    patch: np.ndarray,
     label: np.ndarray,
     out_dir: Path,
     affine: np.ndarray,
+    dtype: str = "float32",
 ) -> None:
-    for mod, data in modalities.items():
+    for mod, data in zip(mod_names, patch):
         out_path = out_dir / f"{pid}_{mod}_{patch_type}_{patch_idx:04d}.nii.gz"
-        nib.save(nib.Nifti1Image(data.astype(np.float32), affine), out_path)
+        nib.save(to_nifti(data, affine, dtype), out_path)
     label_path = out_dir / f"{pid}_label_{patch_type}_{patch_idx:04d}.nii.gz"
-    nib.save(nib.Nifti1Image(label.astype(np.float32), affine), label_path)
+    label_dtype = np.float32 if dtype == "float32" else np.uint8
+    nib.save(nib.Nifti1Image(label.astype(label_dtype, copy=False), affine), label_path)
 
 
-def process_case(
+def spatial_shape(img: nib.Nifti1Image, pid: str, name: str) -> tuple[int, int, int]:
+    """Return the 3D shape of ``img``, dropping trailing singleton dimensions such as ``(Z, Y, X, 1)``."""
+    if len(img.shape) < 3 or any(d != 1 for d in img.shape[3:]):
+        raise ValueError(f"{pid}: {name} has shape {img.shape}, expected a 3D volume")
+    return tuple(int(d) for d in img.shape[:3])
+
+
+def load_case(
     case_dir: Path,
-    output_dir: Path,
-    patch_size: tuple[int, int, int],
-    stride: tuple[int, int, int],
     modalities_filter: list[str] | None,
-) -> None:
-    pid = case_dir.name
-    lesion_dir = output_dir / "lesion_patches"
-    background_dir = output_dir / "background_patches"
-    lesion_dir.mkdir(parents=True, exist_ok=True)
-    background_dir.mkdir(parents=True, exist_ok=True)
-
+    mmap: bool = False,
+) -> tuple[list[str], np.ndarray | LazyNormalizedStack, np.ndarray, np.ndarray] | None:
+    """Load and normalize the modalities and ground truth of one subject folder.
+
+    Returns the sorted modality names, the normalized modalities stacked as a
+    ``(M, Z, Y, X)`` array, the label volume and the affine, or ``None`` if the
+    folder has no ground truth or no selected modality.
+    """
     modality_paths: dict[str, Path] = {}
     gt_path: Path | None = None
     for path in case_dir.glob("*.nii*"):
@@ -101,68 +227,159 @@ def process_case(
                 modality_paths[mod] = path
 
     if gt_path is None or not modality_paths:
-        return
-
-    modalities = {}
-    affine = None
-    for mod, p in modality_paths.items():
-        img = nib.load(p)
-        data = normalize_volume(img.get_fdata(dtype=np.float32))
-        modalities[mod] = data.astype(np.float32)
-        if affine is None:
-            affine = img.affine
+        return None
 
     gt_img = nib.load(gt_path)
-    label = gt_img.get_fdata(dtype=np.float32)
-    if affine is None:
-        affine = gt_img.affine
-
-    # Positive patches
-    labeled, num = ndi.label(label > 0)
-    pos_idx = 0
-    for comp in range(1, num + 1):
-        mask = labeled == comp
-        coords = np.where(mask)
-        zmin, ymin, xmin = [int(c.min()) for c in coords]
-        zmax, ymax, xmax = [int(c.max()) for c in coords]
-        pad = 10
-        zmin = max(zmin - pad, 0)
-        ymin = max(ymin - pad, 0)
-        xmin = max(xmin - pad, 0)
-        zmax = min(zmax + pad + 1, label.shape[0])
-        ymax = min(ymax + pad + 1, label.shape[1])
-        xmax = min(xmax + pad + 1, label.shape[2])
-
-        zmin, zmax = ensure_size(zmin, zmax, patch_size[0], label.shape[0])
-        ymin, ymax = ensure_size(ymin, ymax, patch_size[1], label.shape[1])
-        xmin, xmax = ensure_size(xmin, xmax, patch_size[2], label.shape[2])
-
-        slices = (slice(zmin, zmax), slice(ymin, ymax), slice(xmin, xmax))
-        label_patch = label[slices]
-        modality_patches = {m: img[slices] for m, img in modalities.items()}
-        save_patch(pid, "positive", pos_idx, modality_patches, label_patch, lesion_dir, affine)
-        pos_idx += 1
-
-    # Negative patches
-    neg_idx = 0
-    z_starts = generate_indices(label.shape[0], patch_size[0], stride[0])
-    y_starts = generate_indices(label.shape[1], patch_size[1], stride[1])
-    x_starts = generate_indices(label.shape[2], patch_size[2], stride[2])
-    for z in z_starts:
-        for y in y_starts:
-            for x in x_starts:
-                z_end, y_end, x_end = z + patch_size[0], y + patch_size[1], x + patch_size[2]
-                slices = (slice(z, z_end), slice(y, y_end), slice(x, x_end))
-                label_patch = label[slices]
-                if np.any(label_patch > 0):
-                    continue
-                modality_patches = {m: img[slices] for m, img in modalities.items()}
-                save_patch(pid, "negative", neg_idx, modality_patches, label_patch, background_dir, affine)
-                neg_idx += 1
+    shape = spatial_shape(gt_img, case_dir.name, "GT")
+    # Keep the mask in its on-disk type (usually uint8) instead of widening to float.
+    label = np.asanyarray(gt_img.dataobj).reshape(shape)
+
+    mod_names = sorted(modality_paths)
+    images = [nib.load(modality_paths[mod]) for mod in mod_names]
+    for mod, img in zip(mod_names, images):
+        if spatial_shape(img, case_dir.name, mod) != shape:
+            raise ValueError(
+                f"{case_dir.name}: modality {mod!r} has shape {img.shape}, "
+                f"which does not match the ground truth shape {shape}"
+            )
+    affine = images[0].affine
+    # gzip streams cannot be memory-mapped: every lazy patch read would decompress
+    # the file from the start, so compressed subjects are loaded eagerly instead.
+    compressed = [mod for mod in mod_names if modality_paths[mod].name.endswith(".gz")]
+    if mmap and compressed:
+        print(f"{case_dir.name}: --mmap ignored for compressed modalities {compressed}; loading volumes in full")
+    if mmap and not compressed:
+        vol = LazyNormalizedStack([img.dataobj.reshape(shape) for img in images])
+    else:
+        vol = np.empty((len(images),) + shape, dtype=np.float32)
+        for i, img in enumerate(images):
+            normalize_volume(img.get_fdata(dtype=np.float32).reshape(shape), out=vol[i])
+
+    return mod_names, vol, label, affine
+
+
+def process_loaded(
+    pid: str,
+    mod_names: list[str],
+    vol: np.ndarray | LazyNormalizedStack,
+    label: np.ndarray,
+    affine: np.ndarray,
+    output_dir: Path,
+    patch_size: tuple[int, int, int],
+    stride: tuple[int, int, int],
+    dtype: str = "float32",
+    io_threads: int = 4,
+) -> None:
+    """Extract and write the positive and negative patches of a loaded subject."""
+    lesion_dir = output_dir / "lesion_patches"
+    background_dir = output_dir / "background_patches"
+    lesion_dir.mkdir(parents=True, exist_ok=True)
+    background_dir.mkdir(parents=True, exist_ok=True)
 
+    # Patch writes (gzip compression) run on a thread pool so they overlap
+    # with extraction of the next patch. Extraction is much faster than gzip,
+    # so the number of queued patches is capped to bound memory use.
+    io_pool = ThreadPoolExecutor(max_workers=max(1, io_threads))
+    pending = threading.BoundedSemaphore(2 * max(1, io_threads))
+    writes: list[Future] = []
+
+    def submit_write(*args) -> None:
+        pending.acquire()
+        write = io_pool.submit(save_patch, *args)
+        write.add_done_callback(lambda _: pending.release())
+        writes.append(write)
+
+    try:
+        # Positive patches
+        mask = label > 0
+        labeled, _ = ndi.label(mask, structure=LESION_CONNECTIVITY, output=np.int32)
+        bboxes = [bbox for bbox in ndi.find_objects(labeled) if bbox is not None]
+        shape = np.asarray(label.shape[:3])
+        pad = 10
+        starts = np.array([[s.start for s in bbox] for bbox in bboxes], dtype=np.intp).reshape(-1, 3)
+        ends = np.array([[s.stop for s in bbox] for bbox in bboxes], dtype=np.intp).reshape(-1, 3)
+        starts = np.maximum(starts - pad, 0)
+        ends = np.minimum(ends + pad, shape)
+        starts, ends = ensure_size(starts, ends, np.asarray(patch_size), shape)
+
+        pos_idx = 0
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            slices = tuple(slice(a, b) for a, b in zip(start, end))
+            label_patch = label[slices]
+            patch = vol[(slice(None),) + slices]
+            submit_write(pid, "positive", pos_idx, mod_names, patch, label_patch, lesion_dir, affine, dtype)
+            pos_idx += 1
+
+        # Negative patches
+        neg_idx = 0
+        z_starts = generate_indices(label.shape[0], patch_size[0], stride[0])
+        y_starts = generate_indices(label.shape[1], patch_size[1], stride[1])
+        x_starts = generate_indices(label.shape[2], patch_size[2], stride[2])
+        free_starts = lesion_free_starts(mask, (z_starts, y_starts, x_starts), patch_size)
+        for z, y, x in free_starts.tolist():
+            z_end, y_end, x_end = z + patch_size[0], y + patch_size[1], x + patch_size[2]
+            slices = (slice(z, z_end), slice(y, y_end), slice(x, x_end))
+            label_patch = label[slices]
+            patch = vol[(slice(None),) + slices]
+            submit_write(pid, "negative", neg_idx, mod_names, patch, label_patch, background_dir, affine, dtype)
+            neg_idx += 1
+    finally:
+        io_pool.shutdown(wait=True)
+    for write in writes:
+        write.result()
     print(f"{pid}: {pos_idx} positive patches, {neg_idx} negative patches")
 
 
+def process_case(
+    case_dir: Path,
+    output_dir: Path,
+    patch_size: tuple[int, int, int],
+    stride: tuple[int, int, int],
+    modalities_filter: list[str] | None,
+    mmap: bool = False,
+    dtype: str = "float32",
+    io_threads: int = 4,
+) -> None:
+    loaded = load_case(case_dir, modalities_filter, mmap)
+    if loaded is None:
+        return
+    process_loaded(case_dir.name, *loaded, output_dir, patch_size, stride, dtype, io_threads)
+
+
+def prefetch(items: list, load: Callable, depth: int = 2) -> Iterator[tuple]:
+    """Yield ``(item, load(item))``, loading the next items on a background thread.
+
+    At most ``depth`` loaded items exist at once, counting the one the caller
+    is currently handling: the default of 2 keeps one subject loading ahead of
+    the one being processed.
+    """
+    results: queue.Queue = queue.Queue()
+    slots = threading.Semaphore(depth)
+    done = object()
+
+    def producer() -> None:
+        try:
+            for item in items:
+                slots.acquire()
+                results.put((item, load(item)))
+        except BaseException as exc:  # re-raised in the consumer
+            results.put(exc)
+        finally:
+            results.put(done)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        result = results.get()
+        if result is done:
+            return
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+        # The caller has finished with this item, so another may be loaded.
+        del result
+        slots.release()
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Prepare dataset into patches")
     parser.add_argument("input_dir", help="Directory with raw subject folders")
@@ -182,6 +399,33 @@ def main() -> None:
         default=None,
         help="Optional list of modalities to process (default: all found)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of subjects processed in parallel (default: CPU count)",
+    )
+    parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help=(
+            "Read modality patches lazily from memory-mapped volumes instead of loading "
+            "them whole; percentiles are estimated on a subsample. Only applies to "
+            "uncompressed .nii inputs: subjects with .nii.gz modalities are loaded in full"
+        ),
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=("float32", "int16"),
+        default="float32",
+        help="On-disk type of modality patches; int16 halves file size (labels are then stored as uint8)",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=4,
+        help="Threads per subject used to compress and write patches (default: 4)",
+    )
     args = parser.parse_args()
 
     patch_size = tuple(args.patch_size)
@@ -194,10 +438,31 @@ def main() -> None:
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    modalities_filter = args.modalities
-    for case in sorted(input_dir.iterdir()):
-        if case.is_dir():
-            process_case(case, output_dir, patch_size, stride, modalities_filter)
+    cases = [case for case in sorted(input_dir.iterdir()) if case.is_dir()]
+    if args.workers <= 1:
+        # Load the next subject on a background thread while this one is processed.
+        loader = functools.partial(load_case, modalities_filter=args.modalities, mmap=args.mmap)
+        for case, loaded in prefetch(cases, loader):
+            if loaded is not None:
+                process_loaded(
+                    case.name, *loaded, output_dir, patch_size, stride, args.dtype, args.io_threads
+                )
+            # Drop this subject before prefetch() is allowed to load another one.
+            loaded = None
+        return
+
+    worker = functools.partial(
+        process_case,
+        output_dir=output_dir,
+        patch_size=patch_size,
+        stride=stride,
+        modalities_filter=args.modalities,
+        mmap=args.mmap,
+        dtype=args.dtype,
+        io_threads=args.io_threads,
+    )
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        list(ex.map(worker, cases, chunksize=1))
 
 
 if __name__ == "__main__":